@@ -14,6 +14,11 @@ import sys
 import json
 import errno
 import atexit
+import hashlib
+import time
+import urllib
+import collections
+import difflib
 
 
 class Logger(object):
@@ -110,6 +115,31 @@ class GitInteractor(object):
 
         return files_list
 
+    @staticmethod
+    def git_query_files_at(commit):
+        """Query all *.js files in the tree of the specified commit
+
+        The files are processed into a list of paths.
+        """
+        pipe = subprocess.PIPE
+
+        git_command = ['git', 'ls-tree', '-r', '--name-only', commit]
+        git_query = subprocess.Popen(git_command, stdout=pipe, stderr=pipe)
+        stdout, stderr = git_query.communicate()
+
+        if git_query.poll() != 0:
+            raise RuntimeError(
+                'Error: git ls-tree did not return with 0. (Stdout: {0}) (Stderr: {1})'.format(stdout, stderr))
+
+        query_answer = stdout
+
+        # Answer is coming as a string, but we need a list
+        files_list = query_answer.split('\n')
+        # ls-tree can not filter for *.js in subdirectories, so we filter here (and for empty elements as well)
+        files_list = filter(lambda onefile: onefile.endswith('.js'), files_list)
+
+        return files_list
+
     @staticmethod
     def git_query_head():
         """Query the long hash of the commit of HEAD in working directory"""
@@ -153,12 +183,30 @@ class GitInteractor(object):
 
 
 class BabelInteractor:
-    def __init__(self, babel_transpilation_temp_folder_path, reimport_full_branch, logger, ignores, config):
+    def __init__(self, babel_transpilation_temp_folder_path, reimport_full_branch, logger, ignores, config,
+                 in_memory=False, memory_budget=0):
         self.babel_transpilation_temp_folder_path = babel_transpilation_temp_folder_path
         self.reimport_full_branch = reimport_full_branch
         self.logger = logger
         self.ignores = ignores
         self.config = config
+        self.in_memory = in_memory
+        self.memory_budget = memory_budget
+        # In in-memory mode: filename -> transpiled contents
+        self.transpiled_contents = {}
+        self.buffered_size = 0
+
+    def ensure_temp_folder(self):
+        """Creates the temporary transpilation directory, if it has not been created yet
+
+        In in-memory mode, the directory is only needed if the transpiled files exceed the memory budget.
+        """
+        if self.babel_transpilation_temp_folder_path is None:
+            self.babel_transpilation_temp_folder_path = Miscellanious.create_temp_directory()
+            self.logger.print_verbose(
+                'Babel temporary transpilation directory path: {0}'.format(self.babel_transpilation_temp_folder_path))
+
+        return self.babel_transpilation_temp_folder_path
 
     def transpile_directory(self):
         """Transpile a whole directory with Babel to the temporary transpilation directory
@@ -221,6 +269,49 @@ class BabelInteractor:
 
         return outfile
 
+    def transpile_file_to_memory(self, infile):
+        """Transpile one file with Babel, without writing it to the disk
+
+        Babel writes the transpiled file to its standard output if no output file is specified.
+        The transpiled contents are kept in memory while they fit into the memory budget, the files above the budget
+        are spilled to the temporary transpilation directory.
+        Return the transpiled file's path if it has been spilled to the disk, None otherwise.
+        """
+        pipe = subprocess.PIPE
+
+        if self.logger.debug:
+            stderr = pipe
+        else:
+            stderr = open(os.devnull, 'w')
+
+        babel_command = ['babel', infile]
+
+        # External configuration options for babel from codemodel_rifle_babel file
+        babel_command.extend(self.config)
+
+        babel = subprocess.Popen(babel_command, stdout=pipe, stderr=stderr)
+
+        contents, stderr = babel.communicate()
+
+        if babel.poll() != 0:
+            raise RuntimeError(infile)
+
+        if self.buffered_size + len(contents) <= self.memory_budget:
+            self.transpiled_contents[infile] = contents
+            self.buffered_size += len(contents)
+            return None
+
+        if self.logger.debug:
+            self.logger.print_debug('Memory budget exceeded, spilling {0} to the disk...'.format(infile))
+
+        outfile = os.path.join(self.ensure_temp_folder(), infile)
+        Miscellanious.ensure_dir(os.path.dirname(outfile))
+
+        with open(outfile, 'w') as f:
+            f.write(contents)
+
+        return outfile
+
     def transpile(self, files_with_diff_mode_list):
         """Transpilation process
 
@@ -229,6 +320,7 @@ class BabelInteractor:
         Incremental:
         The method gets a filelist with the git diff mode prepended to the files in the list. Based on the diff modes,
         transpiles the files which need to be transpiled to the temporary transpilation directory.
+        In in-memory mode, the files are transpiled into memory instead (see transpile_file_to_memory()).
 
         Full:
         Transpiles every file in the working directory to the temporary babel transpilation directory, except ignored
@@ -260,8 +352,11 @@ class BabelInteractor:
                         if self.logger.debug:
                             self.logger.print_debug('Transpiling {0}...'.format(filename))
 
-                        # We need to know the transpiled files' full path
-                        newfilename = self.transpile_file(filename)
+                        # We need to know the transpiled files' full path (None if the file is kept in memory)
+                        if self.in_memory:
+                            newfilename = self.transpile_file_to_memory(filename)
+                        else:
+                            newfilename = self.transpile_file(filename)
                         # So we append it as a third element of each file "tuple"
                         files_with_diff_mode_list[i].append(newfilename)
                 except Exception as e:
@@ -270,10 +365,56 @@ class BabelInteractor:
 
 
 class CodemodelRifleInteractor:
-    def __init__(self, root_path, maxupload, logger):
+    def __init__(self, root_path, maxupload, logger, query_cache=None, upload_cache=None):
         self.codemodel_rifle_root_path = root_path
         self.max_upload_trials = maxupload
         self.logger = logger
+        self.query_cache = query_cache
+        # Cache entries are kept separately for each Codemodel Rifle server
+        self.server_cache_key = hashlib.sha1(root_path).hexdigest()
+        # The previously uploaded transpiled files, used as the base of delta uploads (None if disabled)
+        self.upload_cache = upload_cache
+        self.delta_supported = True
+        # The manifest of the current revision, if fetched (see codemodel_rifle_get_manifest())
+        self.manifest = None
+
+    def curl_request(self, method, path, data=None):
+        """Sends one HTTP request to Codemodel Rifle with curl
+
+        The request body (if any) is passed to curl on its standard input, so it is neither limited by the maximum
+        length of the command line, nor interpreted by curl (e.g. a leading @ character).
+        Returns the HTTP response code and the response body.
+        If the request could not be sent for more than max_upload_trials times, an IOError is raised.
+        """
+        pipe = subprocess.PIPE
+
+        curl_command = ['curl', '-X', method]
+        if data is not None:
+            curl_command.extend(['--data-binary', '@-'])
+
+        # the HTTP response code is appended to the response body in a separate line
+        curl_command.extend(['-s', '-w', '\n%{http_code}', path])
+
+        # Do-while loop in Python
+        i = 0
+        while True:
+            curl = subprocess.Popen(curl_command, stdin=pipe, stdout=pipe, stderr=pipe)
+            stdout, stderr = curl.communicate(data)
+
+            body, _, http_response_code = stdout.rpartition('\n')
+
+            try:
+                http_response_code = int(http_response_code)
+            except ValueError:
+                http_response_code = ''
+
+            if curl.poll() == 0 and http_response_code != '':
+                return http_response_code, body
+
+            if i >= self.max_upload_trials:
+                raise IOError(path)
+
+            i += 1
 
     def codemodel_rifle_get_last_commit_for_revision(self, revision):
         """Queries the last stored commit for the specified revision from Codemodel Rifle
@@ -303,10 +444,225 @@ class CodemodelRifleInteractor:
 
         return None
 
-    def handle_file(self, filename, diff_mode, transpiled_filename, current_revision, head):
+    def codemodel_rifle_get_manifest(self, revision):
+        """Queries the manifest of the specified revision from Codemodel Rifle
+
+        The answer from Codemodel Rifle arrives in JSON format, containing the SHA-1 hash of the contents of every
+        imported file of the revision/branch: {"files": {path: hash}}
+        """
+        path = self.codemodel_rifle_root_path + '/manifest?branchid=' + revision
+
+        http_response_code, body = self.curl_request('GET', path)
+
+        if http_response_code != 200:
+            raise RuntimeError(
+                'Could not get manifest for revision "{0}" from Codemodel Rifle. '.format(revision) +
+                '(HTTP {0}) (Answer: {1})'.format(http_response_code, body))
+
+        # The answer arrives in JSON
+        json_object = json.loads(body)
+
+        # Kept for checking the bases of delta uploads
+        self.manifest = json_object.get('files', {})
+
+        return self.manifest
+
+    def codemodel_rifle_set_last_commit(self, revision, head):
+        """Records the specified commit as the last imported commit of the revision on Codemodel Rifle
+
+        Needed when no file has to be sent for a commit, as every other request records its commit on its own.
+        Returns False if Codemodel Rifle does not support setting the last commit.
+        If there is a server error, a RuntimeError is raised.
+        """
+        path = self.codemodel_rifle_root_path + '/lastcommit?branchid={0}&commithash={1}'.format(revision, head)
+
+        http_response_code, body = self.curl_request('POST', path)
+
+        if http_response_code in [404, 405, 501]:
+            return False
+
+        if http_response_code != 200:
+            raise RuntimeError(
+                'Could not set last commit for revision "{0}" on Codemodel Rifle. '.format(revision) +
+                '(HTTP {0}) (Answer: {1})'.format(http_response_code, body))
+
+        return True
+
+    @staticmethod
+    def reconcile(files_with_diff_mode_list, manifest, transpiled_contents=None):
+        """Compares the transpiled files with the manifest of Codemodel Rifle
+
+        Returns a new filelist with the git diff mode of each file set to what is needed for Codemodel Rifle to
+        converge to the transpiled files: files missing from Codemodel Rifle are Added, files with a different hash
+        are Modified, files present only on Codemodel Rifle are Deleted. Files with matching hashes are left out.
+        """
+        if transpiled_contents is None:
+            transpiled_contents = {}
+
+        reconciled_list = []
+        local_filenames = set()
+
+        for elem in files_with_diff_mode_list:
+            filename = elem[1]
+            transpiled_filename = elem[2]
+            local_filenames.add(filename)
+
+            contents = transpiled_contents.get(filename)
+            if contents is None:
+                with open(transpiled_filename, 'r') as f:
+                    contents = f.read()
+
+            if filename not in manifest:
+                reconciled_list.append(['A', filename, transpiled_filename])
+            elif manifest[filename] != hashlib.sha1(contents).hexdigest():
+                reconciled_list.append(['M', filename, transpiled_filename])
+
+        for filename in sorted(manifest.keys()):
+            if filename not in local_filenames:
+                reconciled_list.append(['D', filename])
+
+        return reconciled_list
+
+    @staticmethod
+    def make_delta(base, contents):
+        """Creates a line-based delta of the contents against the base
+
+        The delta is a list of operations: [i, j] copies the lines i..j-1 of the base, a string is inserted as is.
+        """
+        base_lines = base.splitlines(True)
+        lines = contents.splitlines(True)
+
+        delta = []
+        matcher = difflib.SequenceMatcher(None, base_lines, lines)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                delta.append([i1, i2])
+            elif tag in ['replace', 'insert']:
+                delta.append(''.join(lines[j1:j2]))
+
+        return delta
+
+    def codemodel_rifle_send_delta(self, filename, contents, current_revision, head):
+        """Sends a modified file to Codemodel Rifle as a delta against its previously uploaded version
+
+        Codemodel Rifle applies the delta only if the hash of its version of the file matches the hash of the base,
+        and acknowledges with the hash of the result: {"hash": ...}
+        Returns True if the delta has been applied, False if the file has to be uploaded in full instead (there is no
+        previously uploaded version, the delta is not smaller than the file, the base (according to the manifest,
+        if fetched, or to Codemodel Rifle) or the acknowledged hash does not match, or Codemodel Rifle does not
+        support delta uploads).
+        If there is a server error, a RuntimeError is raised.
+        """
+        if self.upload_cache is None or not self.delta_supported:
+            return False
+
+        try:
+            base = self.upload_cache.get(*self.upload_cache_keys(current_revision, filename))
+        except (IOError, OSError) as e:
+            self.logger.print_verbose('WARNING: could not read the upload cache for {0} ({1}).'.format(filename, e))
+            return False
+
+        if base is None:
+            return False
+
+        base_hash = hashlib.sha1(base).hexdigest()
+
+        # If the manifest is known, a delta against a stale base is not even sent
+        if self.manifest is not None and self.manifest.get(filename) != base_hash:
+            return False
+
+        contents_hash = hashlib.sha1(contents).hexdigest()
+
+        try:
+            body = json.dumps({'base': base_hash, 'hash': contents_hash, 'delta': self.make_delta(base, contents)})
+        except UnicodeDecodeError:
+            # JSON can only carry UTF-8 encoded files
+            return False
+
+        if len(body) >= len(contents):
+            return False
+
+        path = self.codemodel_rifle_root_path + '/handle?path={0}&branchid={1}&commithash={2}'.format(
+            filename, current_revision, head)
+
+        http_response_code, answer = self.curl_request('PATCH', path, body)
+
+        if http_response_code in [404, 405, 501]:
+            self.logger.print_verbose('Codemodel Rifle does not support delta uploads, uploading full files.')
+            self.delta_supported = False
+            return False
+
+        if http_response_code == 500:
+            raise RuntimeError(filename)
+
+        try:
+            acknowledged_hash = json.loads(answer).get('hash')
+        except ValueError:
+            acknowledged_hash = None
+
+        if http_response_code != 200 or acknowledged_hash != contents_hash:
+            if self.logger.debug:
+                self.logger.print_debug('Delta of {0} was not applied, uploading the full file...'.format(filename))
+            return False
+
+        return True
+
+    def upload_cache_keys(self, current_revision, filename):
+        """Returns the keys of the file in the upload cache
+
+        The directories of the path are kept as separate keys, so that deep paths do not end up in one overlong
+        filename.
+        """
+        return [self.server_cache_key, current_revision] + filename.split('/')
+
+    def remember_upload(self, filename, diff_mode, contents, current_revision):
+        """Stores the uploaded contents of the file as the base of its next delta upload
+
+        As the file has already been uploaded, failing to cache it is not an error, the next upload of the file
+        will be a full one.
+        """
+        if self.upload_cache is None:
+            return
+
+        try:
+            if diff_mode == 'D':
+                self.upload_cache.delete(*self.upload_cache_keys(current_revision, filename))
+            else:
+                self.upload_cache.put(contents, *self.upload_cache_keys(current_revision, filename))
+        except (IOError, OSError) as e:
+            self.logger.print_verbose('WARNING: could not update the upload cache for {0} ({1}).'.format(filename, e))
+
+    def forget_prefix(self, prefix, current_revision):
+        """Removes the cached uploads of every file under the specified directory prefix"""
+        if self.upload_cache is None:
+            return
+
+        try:
+            self.upload_cache.delete_tree(*self.upload_cache_keys(current_revision, prefix.rstrip('/')))
+        except (IOError, OSError) as e:
+            self.logger.print_verbose('WARNING: could not update the upload cache for {0} ({1}).'.format(prefix, e))
+
+    def prune_caches(self, current_revision, max_age_days):
+        """Removes the cached entries of the revisions of this server not imported for max_age_days days
+
+        Failing to prune the caches is not an error.
+        """
+        for cache in [self.query_cache, self.upload_cache]:
+            if cache is None:
+                continue
+
+            try:
+                cache.touch(self.server_cache_key, current_revision)
+                cache.prune(max_age_days * 24 * 60 * 60, self.server_cache_key)
+            except (IOError, OSError) as e:
+                self.logger.print_verbose('WARNING: could not prune the cache directory ({0}).'.format(e))
+
+    def handle_file(self, filename, diff_mode, transpiled_filename, current_revision, head, contents=None):
         """Sends the specified file to Codemodel Rifle for processing
 
-        Reads the contents of the file, and sends the file to Codemodel Rifle based on the file's diff mode.
+        Reads the contents of the file (unless the transpiled contents are given), and sends the file to
+        Codemodel Rifle based on the file's diff mode. Modified files are sent as a delta if possible
+        (see codemodel_rifle_send_delta()).
         If there is a server error (e.g. Codemodel Rifle was not able to parse the file), a RuntimeError is raised.
         If there is a network error (e.g. could not send the file to the server), an IOError is raised.
         """
@@ -316,50 +672,171 @@ class CodemodelRifleInteractor:
         path = self.codemodel_rifle_root_path + codemodel_rifle_handle_data_path
 
         # if the file was deleted, it was not transpiled a all, so we can not open, nor read it
-        if diff_mode != 'D':
+        if diff_mode != 'D' and contents is None:
             with open(transpiled_filename, 'r') as f:
                 contents = f.read()
 
-        pipe = subprocess.PIPE
+        if diff_mode == 'M' and self.codemodel_rifle_send_delta(filename, contents, current_revision, head):
+            self.remember_upload(filename, diff_mode, contents, current_revision)
+            return True
 
-        # Do-while loop in Python
-        i = 0
-        while True:
-            if diff_mode == 'A':
-                curl_command = ['curl', '-X', 'POST', '--data-binary', contents, path]
-            elif diff_mode == 'M':
-                curl_command = ['curl', '-X', 'PUT', '--data-binary', contents, path]
-            else:
-                # diff mode can only be Deleted here
-                curl_command = ['curl', '-X', 'DELETE', path]
+        if diff_mode == 'A':
+            method = 'POST'
+        elif diff_mode == 'M':
+            method = 'PUT'
+        else:
+            # diff mode can only be Deleted here
+            method = 'DELETE'
 
-            # we need only the HTTP response code, so we tell curl about it
-            curl_command.extend(['-s', '-o', os.path.devnull, '-w', '%{http_code}'])
+        try:
+            http_response_code, answer = self.curl_request(method, path, contents)
+        except IOError:
+            raise IOError(filename)
 
-            curl = subprocess.Popen(curl_command, stdout=pipe, stderr=pipe)
+        if http_response_code == 500:
+            raise RuntimeError(filename)
 
-            stdout, stderr = curl.communicate()
+        self.remember_upload(filename, diff_mode, contents, current_revision)
+        return True
 
-            # stdout contains nothing else than HTTP response code
-            # but we check it to make sure
-            try:
-                http_response_code = int(stdout)
-            except ValueError:
-                http_response_code = ''
+    def codemodel_rifle_delete_bulk(self, kind, query, body, description):
+        """Sends a bulk delete request to Codemodel Rifle
 
-            if curl.poll() == 0 and http_response_code != 500:
-                return True
+        Returns True if the files were deleted, False if Codemodel Rifle does not support bulk deletes.
+        If there is a server error, a RuntimeError is raised.
+        """
+        path = self.codemodel_rifle_root_path + '/handle/{0}?{1}'.format(kind, query)
 
-            if http_response_code == 500:
-                raise RuntimeError(filename)
+        http_response_code, answer = self.curl_request('DELETE', path, body)
 
-            if i >= self.max_upload_trials:
-                raise IOError(filename)
+        if http_response_code in [404, 405, 501]:
+            return False
 
-            i += 1
+        if http_response_code == 500:
+            raise RuntimeError(description)
+
+        return True
+
+    def codemodel_rifle_delete_prefix(self, prefix, current_revision, head):
+        """Deletes every file under the specified directory prefix from Codemodel Rifle with one request"""
+        query = 'prefix={0}&branchid={1}&commithash={2}'.format(prefix, current_revision, head)
+
+        if not self.codemodel_rifle_delete_bulk('prefix', query, None, prefix):
+            return False
+
+        self.forget_prefix(prefix, current_revision)
+
+        return True
+
+    def codemodel_rifle_delete_list(self, filenames, current_revision, head):
+        """Deletes the specified files from Codemodel Rifle with one request
+
+        The paths are sent in the request body in JSON format: {"paths": [...]}
+        """
+        query = 'branchid={0}&commithash={1}'.format(current_revision, head)
+        body = json.dumps({'paths': filenames})
+
+        if not self.codemodel_rifle_delete_bulk('bulk', query, body, '{0} files'.format(len(filenames))):
+            return False
+
+        for filename in filenames:
+            self.remember_upload(filename, 'D', None, current_revision)
+
+        return True
+
+    @staticmethod
+    def collapse_deletions(deleted_filenames, previous_filenames):
+        """Collapses the deleted files into directory prefixes where possible
+
+        A directory is collapsed if every file of it (and of its subdirectories) in the previously imported tree
+        has been deleted. Only the topmost of these directories are returned, with a trailing slash.
+        Returns the prefixes and the deleted files not covered by any of them.
+        """
+        previous_counts = collections.Counter()
+        for filename in previous_filenames:
+            for directory in Miscellanious.parent_directories(filename):
+                previous_counts[directory] += 1
+
+        deleted_counts = collections.Counter()
+        for filename in deleted_filenames:
+            for directory in Miscellanious.parent_directories(filename):
+                deleted_counts[directory] += 1
+
+        prefixes = []
+        # Shallower directories come first, so that their subdirectories are skipped
+        for directory in sorted(deleted_counts.keys(), key=lambda d: (d.count('/'), d)):
+            if any(directory.startswith(prefix) for prefix in prefixes):
+                continue
+
+            # A directory with a single file is not worth a prefix delete
+            if deleted_counts[directory] > 1 and deleted_counts[directory] == previous_counts[directory]:
+                prefixes.append(directory)
+
+        remaining = filter(lambda onefile: not any(onefile.startswith(prefix) for prefix in prefixes),
+                           deleted_filenames)
+
+        return prefixes, remaining
+
+    def handle_deletions(self, deleted_filenames, previous_filenames, current_revision, head):
+        """Deletes the specified files from Codemodel Rifle with as few requests as possible
+
+        Whole deleted directory subtrees are deleted with one prefix delete each, the rest of the deleted files with
+        one bulk list delete. If Codemodel Rifle does not support these, the files are deleted one by one.
+        """
+        prefixes, remaining = self.collapse_deletions(deleted_filenames, previous_filenames)
+
+        for prefix in prefixes:
+            if self.logger.debug:
+                self.logger.print_debug('Deleting {0} from Codemodel Rifle...'.format(prefix))
+
+            if not self.codemodel_rifle_delete_prefix(prefix, current_revision, head):
+                self.logger.print_verbose('Codemodel Rifle does not support prefix deletes, deleting files one by one.')
+                # Prefix deletes are either supported or not, so none of the prefixes has been deleted
+                remaining = deleted_filenames
+                break
+
+        if len(remaining) > 1:
+            if self.logger.debug:
+                self.logger.print_debug('Deleting {0} files from Codemodel Rifle...'.format(len(remaining)))
+
+            if self.codemodel_rifle_delete_list(remaining, current_revision, head):
+                return
+
+            self.logger.print_verbose('Codemodel Rifle does not support bulk deletes, deleting files one by one.')
+
+        for filename in remaining:
+            if self.logger.debug:
+                self.logger.print_debug('Sending {0} to Codemodel Rifle...'.format(filename))
+
+            self.handle_file(filename, 'D', filename, current_revision, head)
+
+    def handle(self, files_with_diff_mode_list, current_revision, head, transpiled_contents=None,
+               previous_filenames=None):
+        """Sends each file from the specified list to Codemodel Rifle for processing.
+
+        Files transpiled in memory are sent from transpiled_contents (filename -> transpiled contents).
+        If the files of the previously imported tree are given, deleted files are sent first, collapsed into
+        prefix and bulk deletes (see handle_deletions()). A server error during the deletions does not stop the
+        upload of the other files.
+        Returns True if every file has been handled, False if some deletions failed.
+        """
+        if transpiled_contents is None:
+            transpiled_contents = {}
+
+        complete = True
+
+        if previous_filenames is not None:
+            deleted_filenames = [elem[1] for elem in files_with_diff_mode_list if elem[0] == 'D']
+            if deleted_filenames:
+                try:
+                    self.handle_deletions(deleted_filenames, previous_filenames, current_revision, head)
+                except RuntimeError as e:
+                    self.logger.print_log('ERROR thrown by Codemodel Rifle while deleting {0}. '.format(e.message) +
+                                          'Continuing with the upload of the other files.')
+                    complete = False
+
+            files_with_diff_mode_list = filter(lambda elem: elem[0] != 'D', files_with_diff_mode_list)
 
-    def handle(self, files_with_diff_mode_list, current_revision, head):
-        """Sends each file from the specified list to Codemodel Rifle for processing."""
         for elem in files_with_diff_mode_list:
             diff_mode = elem[0]
             filename = elem[1]
@@ -371,7 +848,195 @@ class CodemodelRifleInteractor:
             if self.logger.debug:
                 self.logger.print_debug('Sending {0} to Codemodel Rifle...'.format(filename))
 
-            self.handle_file(filename, diff_mode, transpiled_filename, current_revision, head)
+            self.handle_file(filename, diff_mode, transpiled_filename, current_revision, head,
+                             transpiled_contents.get(filename))
+
+        return complete
+
+    @staticmethod
+    def parse_query_answer(queryname, http_response_code, body):
+        """Parses the answer of Codemodel Rifle for a submitted or polled query
+
+        The answer arrives in JSON format. A finished query is answered with {"status": "done", "result": ...},
+        a query still running on the server with {"status": "running", "queryId": ...}.
+        If the query failed on the server, a RuntimeError is raised.
+        """
+        if http_response_code != 200:
+            raise RuntimeError(
+                'Query "{0}" failed on Codemodel Rifle. (HTTP {1}) (Answer: {2})'.format(queryname,
+                                                                                          http_response_code, body))
+
+        json_object = json.loads(body)
+
+        if json_object.get('status') not in ['done', 'running']:
+            raise RuntimeError(
+                'Query "{0}" failed on Codemodel Rifle. (Answer: {1})'.format(queryname, body))
+
+        return json_object
+
+    def codemodel_rifle_submit_query(self, queryname, query, revision, head):
+        """Submits the specified Cypher query to Codemodel Rifle for the specified revision and commit"""
+        path = self.codemodel_rifle_root_path + '/query?name={0}&branchid={1}&commithash={2}'.format(queryname,
+                                                                                                    revision, head)
+
+        http_response_code, body = self.curl_request('POST', path, query)
+
+        return self.parse_query_answer(queryname, http_response_code, body)
+
+    def codemodel_rifle_poll_query(self, queryname, query_id):
+        """Polls the state of a previously submitted, still running query from Codemodel Rifle"""
+        path = self.codemodel_rifle_root_path + '/query?queryid={0}'.format(query_id)
+
+        http_response_code, body = self.curl_request('GET', path)
+
+        return self.parse_query_answer(queryname, http_response_code, body)
+
+    def query(self, queries, revision, head, poll_interval, timeout, cache_results=True):
+        """Runs the specified named queries on Codemodel Rifle, and returns their results
+
+        Every query is submitted first, and the queries still running on the server are polled afterwards, so that
+        the server can evaluate them in parallel.
+        Results are cached on disk, keyed by the Codemodel Rifle server, the revision, the commit and the hash of the
+        query. Cached results are returned without contacting Codemodel Rifle. New results are only cached if
+        cache_results is set, i.e. the commit has been fully imported.
+        If a query does not finish in timeout seconds, a RuntimeError is raised.
+        """
+        results = collections.OrderedDict()
+        # queryname -> (query hash, query ID on the server)
+        pending = collections.OrderedDict()
+
+        for queryname, query in queries:
+            query_hash = hashlib.sha1(query).hexdigest()
+
+            if self.query_cache is not None:
+                try:
+                    cached = self.query_cache.get(self.server_cache_key, revision, head, query_hash)
+                except (IOError, OSError) as e:
+                    self.logger.print_verbose(
+                        'WARNING: could not read the query cache for query "{0}" ({1}).'.format(queryname, e))
+                    cached = None
+
+                if cached is not None:
+                    self.logger.print_verbose('Using cached result for query "{0}".'.format(queryname))
+                    results[queryname] = json.loads(cached)
+                    continue
+
+            if self.logger.debug:
+                self.logger.print_debug('Submitting query "{0}" to Codemodel Rifle...'.format(queryname))
+
+            results[queryname] = None
+            answer = self.codemodel_rifle_submit_query(queryname, query, revision, head)
+
+            if answer['status'] == 'done':
+                self.store_query_result(queryname, query_hash, answer['result'], revision, head, results,
+                                        cache_results)
+            else:
+                pending[queryname] = (query_hash, answer['queryId'])
+
+        deadline = time.time() + timeout
+        while pending:
+            if time.time() > deadline:
+                raise RuntimeError('Queries did not finish on Codemodel Rifle in {0} seconds: {1}'.format(
+                    timeout, ', '.join(pending.keys())))
+
+            time.sleep(poll_interval)
+
+            for queryname in list(pending.keys()):
+                query_hash, query_id = pending[queryname]
+                answer = self.codemodel_rifle_poll_query(queryname, query_id)
+
+                if answer['status'] == 'done':
+                    self.store_query_result(queryname, query_hash, answer['result'], revision, head, results,
+                                            cache_results)
+                    del pending[queryname]
+
+        return results
+
+    def store_query_result(self, queryname, query_hash, result, revision, head, results, cache_results):
+        """Stores the result of a finished query in the results and (if cache_results is set) in the on-disk cache
+
+        Failing to cache the result is not an error, the query is run again next time.
+        """
+        results[queryname] = result
+
+        if self.query_cache is None or not cache_results:
+            return
+
+        try:
+            self.query_cache.put(json.dumps(result), self.server_cache_key, revision, head, query_hash)
+        except (IOError, OSError) as e:
+            self.logger.print_verbose(
+                'WARNING: could not cache the result of query "{0}" ({1}).'.format(queryname, e))
+
+
+class DiskCache:
+    """Basic on-disk cache
+
+    Every entry is stored in a separate file. The keys of an entry are used as the (escaped) path components of
+    the file within the cache directory, so entries can be grouped, e.g. by revision and commit, and whole groups
+    can be removed at once.
+    """
+
+    def __init__(self, cache_directory_path):
+        self.cache_directory_path = cache_directory_path
+
+    def entry_path(self, *keys):
+        # Keys (e.g. branch names) can contain slashes, therefore every key is escaped
+        return os.path.join(self.cache_directory_path, *[urllib.quote(key, safe='') for key in keys])
+
+    def get(self, *keys):
+        """Returns the contents of the specified entry, or None if the entry is not cached"""
+        entry = self.entry_path(*keys)
+
+        if not os.path.isfile(entry):
+            return None
+
+        with open(entry, 'r') as f:
+            return f.read()
+
+    def put(self, contents, *keys):
+        """Stores the contents as the specified entry
+
+        The entry is written to a temporary file first and renamed afterwards, so an interrupted run can not leave
+        a partially written entry in the cache.
+        """
+        entry = self.entry_path(*keys)
+        Miscellanious.ensure_dir(os.path.dirname(entry))
+
+        temp_entry = '{0}.{1}.tmp'.format(entry, os.getpid())
+        with open(temp_entry, 'w') as f:
+            f.write(contents)
+        os.rename(temp_entry, entry)
+
+    def delete(self, *keys):
+        """Removes the specified entry, if cached"""
+        entry = self.entry_path(*keys)
+
+        if os.path.isfile(entry):
+            os.remove(entry)
+
+    def delete_tree(self, *keys):
+        """Removes every entry within the specified group"""
+        Application.clean_directory(self.entry_path(*keys))
+
+    def touch(self, *keys):
+        """Marks the specified group as used now"""
+        group = self.entry_path(*keys)
+        Miscellanious.ensure_dir(group)
+        os.utime(group, None)
+
+    def prune(self, max_age, *keys):
+        """Removes the subgroups of the specified group not marked as used (see touch()) for max_age seconds"""
+        group = self.entry_path(*keys)
+
+        if not os.path.isdir(group):
+            return
+
+        oldest = time.time() - max_age
+        for subgroup in os.listdir(group):
+            subgroup_path = os.path.join(group, subgroup)
+            if os.path.isdir(subgroup_path) and os.path.getmtime(subgroup_path) < oldest:
+                shutil.rmtree(subgroup_path)
 
 
 class Miscellanious:
@@ -391,14 +1056,41 @@ class Miscellanious:
             if e.errno != errno.EEXIST:
                 raise
 
+    @staticmethod
+    def parent_directories(filename):
+        """Returns the parent directories of the specified relative path, with trailing slashes
+
+        E.g. for app/lib/a.js: ['app/', 'app/lib/']
+        """
+        parts = filename.split('/')[:-1]
+        return ['/'.join(parts[:i]) + '/' for i in range(1, len(parts) + 1)]
+
+    @staticmethod
+    def create_temp_directory():
+        """Creates a temporary transpilation directory for Babel
+
+        The directory is removed at exit.
+        """
+        directory_suffix = datetime.datetime.now().strftime('_%Y-%m-%d_%H%M%S')
+        directory_prefix = 'codemodel_rifle_temp_'
+        directory = tempfile.mkdtemp(directory_suffix, directory_prefix)
+
+        # Registering temp directory cleanup function
+        atexit.register(Application.clean_directory, directory)
+
+        return directory
+
 
 class Application:
-    def __init__(self, reimport_full_branch, ignorefile, babelconfigfile):
+    def __init__(self, reimport_full_branch, reconcile, ignorefile, babelconfigfile, queryfiles):
         self.reimport_full_branch = reimport_full_branch
+        self.reconcile = reconcile
         self.ignorefile = ignorefile
         self.babelconfigfile = babelconfigfile
+        self.queryfiles = queryfiles
         self.ignores = []
         self.babelconfig = []
+        self.queries = []
 
     def read_ignore(self):
         """Reads and parses the provided ignorefile.
@@ -440,6 +1132,25 @@ class Application:
 
         return False
 
+    def read_queries(self):
+        """Reads the provided query files.
+
+        Every query is named after its file, without the extension. (E.g. queries/unused_variables.cypher is named
+        unused_variables.) Query names have to be unique, otherwise a ValueError is raised.
+        """
+        queries = []
+        for queryfile in self.queryfiles:
+            queryname = os.path.splitext(os.path.basename(queryfile))[0]
+            if queryname in [name for name, query in queries]:
+                raise ValueError('Query name "{0}" of {1} is not unique. '.format(queryname, queryfile) +
+                                 'Query files have to be named differently, even in different directories.')
+
+            with open(queryfile, 'r') as f:
+                query = f.read()
+            queries.append((queryname, query))
+
+        self.queries = queries
+
     @staticmethod
     def clean_directory(directory):
         # Checks if exists and is a directory
@@ -447,6 +1158,42 @@ class Application:
             shutil.rmtree(directory)
 
 
+def run_queries(rifle, application, current_revision, head, poll_interval, timeout, logger, import_complete=True):
+    """Runs the queries read by the application on Codemodel Rifle, and prints their results
+
+    Results of queries run on a partially imported commit are not cached.
+    """
+    if not application.queries:
+        return
+
+    logger.print_verbose('** Running queries on Codemodel Rifle...')
+
+    try:
+        results = rifle.query(application.queries, current_revision, head, poll_interval, timeout, import_complete)
+    except RuntimeError as e:
+        logger.print_log('ERROR while running queries on Codemodel Rifle.')
+        logger.print_log(e.message)
+        logger.print_log('Aborting.')
+        sys.exit(1)
+    except IOError as e:
+        logger.print_log('ERROR while sending query requests to Codemodel Rifle ({0}). '.format(e.message) +
+                         'Request failed for more than {0} times. '.format(rifle.max_upload_trials) +
+                         'Override this by specifying the --max-upload-trials flag.')
+        logger.print_log('Aborting.')
+        sys.exit(1)
+    except Exception:
+        logger.print_log('UNEXPECTED ERROR while running queries on Codemodel Rifle.')
+        logger.print_log('Aborting.')
+        sys.exit(1)
+
+    for queryname, result in results.items():
+        logger.print_log('Result of query "{0}":'.format(queryname))
+        for line in json.dumps(result, indent=2, sort_keys=True).split('\n'):
+            logger.print_log(line)
+
+    logger.print_verbose('** Successfully ran all queries on Codemodel Rifle.')
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Get the modified files since the last commit, ' +
@@ -486,12 +1233,56 @@ def main():
                         help='Do not search for previously imported commits of branch (revision), ' +
                              'upload the whole branch/revision to Codemodel Rifle instead. ' +
                              'Previously imported data for the branch will be deleted from Codemodel Rifle.')
+    parser.add_argument('-r', '--reconcile', action='store_true',
+                        help='Like --reimport-full-branch, but instead of deleting and re-uploading the whole ' +
+                             'branch, compare the transpiled files with the manifest (the hashes of the imported ' +
+                             'files) of the branch on Codemodel Rifle, and only upload or delete the differing ' +
+                             'files. Useful for repairing a branch with some files out of sync.')
+    parser.add_argument('-q', '--query', action='append',
+                        help='Cypher query file to run on Codemodel Rifle after the import. The query is named after ' +
+                             'the file, and its result is printed. Can be specified multiple times.',
+                        metavar='QUERYFILE', dest='queryfiles', default=[])
+    parser.add_argument('--query-poll-interval', type=float,
+                        help='Seconds to wait between polling the results of running queries. Defaults to 2.',
+                        metavar='SECONDS', default=2)
+    parser.add_argument('--query-timeout', type=float,
+                        help='Maximum seconds to wait for the queries to finish. Defaults to 600.',
+                        metavar='SECONDS', default=600)
+    parser.add_argument('-c', '--cache-dir',
+                        help='Directory of the local cache. Query results are cached here for each revision, commit ' +
+                             'and query, so unchanged commits reuse them instead of re-running the queries. ' +
+                             'With --delta-uploads, the uploaded transpiled files are cached here as well. ' +
+                             'Defaults to "~/.codemodel_rifle_cache".',
+                        metavar='CACHEDIR', default='~/.codemodel_rifle_cache')
+    parser.add_argument('--cache-max-age', type=int,
+                        help='The cached entries of branches (revisions) not imported for this many days are removed ' +
+                             'from the cache directory. Defaults to 30.',
+                        metavar='DAYS', default=30)
+    parser.add_argument('--delta-uploads', action='store_true',
+                        help='Keep the uploaded transpiled files in the cache directory, and send modified files as ' +
+                             'a delta against their previously uploaded version. Falls back to uploading the full ' +
+                             'file if Codemodel Rifle has a different version of it.')
+    parser.add_argument('-m', '--in-memory', action='store_true',
+                        help='Keep the files transpiled by Babel in memory and send them directly to Codemodel ' +
+                             'Rifle, instead of writing them to a temporary transpilation directory. Files that do ' +
+                             'not fit into the memory budget are still written to the disk. Full branch reimports ' +
+                             '(-f) and reconciliations (-r) always use the temporary transpilation directory.')
+    parser.add_argument('--memory-budget', type=int,
+                        help='Memory budget of the in-memory mode (-m) in megabytes. Defaults to 256.',
+                        metavar='MB', default=256)
     args = parser.parse_args()
 
     git = GitInteractor(args.project_git_repository_path)
     logger = Logger(args.verbose, args.debug)
-    rifle = CodemodelRifleInteractor(args.codemodel_rifle_root_path.rstrip('/'), args.max_upload_trials, logger)
-    application = Application(args.reimport_full_branch, args.ignorefile, args.babel_config_file)
+    # The cache directory has to be resolved before switching to the git repository
+    cache_directory = os.path.abspath(os.path.expanduser(args.cache_dir))
+    # Nothing is written to the cache directory unless queries or delta uploads are used
+    query_cache = DiskCache(os.path.join(cache_directory, 'queries')) if args.queryfiles else None
+    upload_cache = DiskCache(os.path.join(cache_directory, 'uploads')) if args.delta_uploads else None
+    rifle = CodemodelRifleInteractor(args.codemodel_rifle_root_path.rstrip('/'), args.max_upload_trials, logger,
+                                     query_cache, upload_cache)
+    application = Application(args.reimport_full_branch, args.reconcile, args.ignorefile, args.babel_config_file,
+                              args.queryfiles)
 
     # Saving the current directory
     # Before exiting, we switch back here
@@ -550,6 +1341,32 @@ def main():
 
     logger.print_verbose('* Babelconfigfile successfully read.')
 
+    logger.print_verbose('* Reading query files...')
+
+    try:
+        application.read_queries()
+    except (OSError, IOError) as e:
+        logger.print_log('ERROR during reading the query files ({0}).'.format(', '.join(application.queryfiles)))
+        logger.print_log(e.strerror)
+        logger.print_log('Aborting.')
+        sys.exit(1)
+    except ValueError as e:
+        logger.print_log('ERROR during reading the query files.')
+        logger.print_log(e.message)
+        logger.print_log('Aborting.')
+        sys.exit(1)
+    except Exception:
+        logger.print_log('UNEXPECTED ERROR while reading query files ({0}).'.format(
+            ', '.join(application.queryfiles)))
+        logger.print_log('Aborting.')
+        sys.exit(1)
+    else:
+        for queryname, query in application.queries:
+            logger.print_debug('Query "{0}":'.format(queryname))
+            logger.print_debug(query)
+
+    logger.print_verbose('* Query files successfully read.')
+
     logger.print_verbose('* Switching to the specified git repository ({0})...'.format(git.project_git_repository_path))
 
     try:
@@ -630,18 +1447,26 @@ def main():
 
     logger.print_verbose('* Last commit for revision successfully acquired from Codemodel Rifle.')
 
-    full_import = (rifle.last_uploaded_commit_on_revision is None) or application.reimport_full_branch
+    rifle.prune_caches(git.current_revision, args.cache_max_age)
+
+    full_import = ((rifle.last_uploaded_commit_on_revision is None) or application.reimport_full_branch or
+                   application.reconcile)
 
-    if full_import:
+    if application.reconcile:
+        logger.print_verbose('* Reconciling full repository with Codemodel Rifle (--reconcile)...')
+    elif full_import:
         logger.print_verbose(
             '* Importing full repository to Codemodel Rifle (--reimport-full-branch or no uploaded commit ' +
             'for revision on Codemodel Rifle)...')
     else:
         logger.print_verbose('* Incrementally import repository...')
 
-    # If not explicitly requested with --reimport-full-branch (-f), we do nothing if the HEAD has already been imported
+    # If not explicitly requested with --reimport-full-branch (-f) or --reconcile (-r),
+    # we do nothing if the HEAD has already been imported
     if not full_import and git.head == rifle.last_uploaded_commit_on_revision:
         logger.print_log('The current commit has already been imported to Codemodel Rifle.')
+        run_queries(rifle, application, git.current_revision, git.head, args.query_poll_interval,
+                    args.query_timeout, logger)
         logger.print_log('Exiting.')
         sys.exit(0)
 
@@ -677,31 +1502,62 @@ def main():
 
     logger.print_verbose('** Successfully filtered out ignored files.')
 
-    logger.print_verbose('** Creating temporary transpilation directory for Babel.')
+    previous_files_list = None
+    deleted_count = len(filter(lambda onefile: onefile[0] == 'D', files_list))
 
-    try:
-        directory_suffix = datetime.datetime.now().strftime('_%Y-%m-%d_%H%M%S')
-        directory_prefix = 'codemodel_rifle_temp_'
-        babel_transpilation_temp_folder = tempfile.mkdtemp(directory_suffix, directory_prefix)
-    except OSError as e:
-        logger.print_log('ERROR during creating temporary folder for Babel transpilation.')
-        logger.print_log(e.strerror)
-        logger.print_log('Aborting.')
-        sys.exit(1)
-    except Exception:
-        logger.print_log('UNEXPECTED ERROR while creating temporary folder for Babel transpilation.')
-        logger.print_log('Aborting.')
-        sys.exit(1)
+    # Mass deletions (e.g. a removed directory) are collapsed into prefix and bulk deletes,
+    # for which we need to know the files of the previously imported tree
+    if deleted_count > 1:
+        logger.print_verbose('** Fetching previously imported files for collapsing deletions...')
+
+        try:
+            previous_files_list = git.git_query_files_at(rifle.last_uploaded_commit_on_revision)
+        except RuntimeError as e:
+            logger.print_log('ERROR during getting the previously imported filelist from Git.')
+            logger.print_log(e.message)
+            logger.print_log('Aborting.')
+            sys.exit(1)
+        except Exception:
+            logger.print_log('UNEXPECTED ERROR while getting the previously imported filelist from Git.')
+            logger.print_log('Aborting.')
+            sys.exit(1)
+        else:
+            previous_files_list = filter(lambda onefile: not application.ignored(onefile), previous_files_list)
+
+        logger.print_verbose('** Previously imported files successfully fetched.')
+
+    # Full branch reimports (and reconciliations) transpile the whole directory with one Babel process,
+    # which needs an output directory
+    transpile_directory = application.reimport_full_branch or application.reconcile
+    in_memory = args.in_memory and not transpile_directory
+
+    if in_memory:
+        logger.print_verbose('** Transpiling in memory, skipping the creation of the temporary transpilation ' +
+                             'directory for Babel.')
+        babel_transpilation_temp_folder = None
     else:
-        # Registering temp directory cleanup function
-        atexit.register(Application.clean_directory, babel_transpilation_temp_folder)
-        logger.print_verbose(
-            'Babel temporary transpilation directory path: {0}'.format(babel_transpilation_temp_folder))
+        logger.print_verbose('** Creating temporary transpilation directory for Babel.')
+
+        try:
+            babel_transpilation_temp_folder = Miscellanious.create_temp_directory()
+        except OSError as e:
+            logger.print_log('ERROR during creating temporary folder for Babel transpilation.')
+            logger.print_log(e.strerror)
+            logger.print_log('Aborting.')
+            sys.exit(1)
+        except Exception:
+            logger.print_log('UNEXPECTED ERROR while creating temporary folder for Babel transpilation.')
+            logger.print_log('Aborting.')
+            sys.exit(1)
+        else:
+            logger.print_verbose(
+                'Babel temporary transpilation directory path: {0}'.format(babel_transpilation_temp_folder))
 
-    logger.print_verbose('** Successfully created temporary transpilation directory for Babel.')
+        logger.print_verbose('** Successfully created temporary transpilation directory for Babel.')
 
-    babel = BabelInteractor(babel_transpilation_temp_folder, application.reimport_full_branch, logger,
-                            application.ignores, application.babelconfig)
+    babel = BabelInteractor(babel_transpilation_temp_folder, transpile_directory, logger,
+                            application.ignores, application.babelconfig, in_memory,
+                            args.memory_budget * 1024 * 1024)
 
     logger.print_verbose('** Transpiling files with Babel...')
 
@@ -710,9 +1566,13 @@ def main():
     except OSError as e:
         logger.print_log('ERROR while transpiling with Babel.')
         logger.print_log('Filename or error message: {0}'.format(e.message))
-        logger.print_log(
-            'It is possibly an error regarding creating child directories in the file\'s path within ' +
-            'the temporary transpilation folder ({0}).'.format(babel.babel_transpilation_temp_folder_path))
+        if babel.babel_transpilation_temp_folder_path is not None:
+            logger.print_log(
+                'It is possibly an error regarding creating child directories in the file\'s path within ' +
+                'the temporary transpilation folder ({0}).'.format(babel.babel_transpilation_temp_folder_path))
+        else:
+            logger.print_log('The error occurred during in-memory transpilation, while running Babel or creating ' +
+                             'the temporary transpilation folder for the files above the memory budget.')
         logger.print_log('Aborting.')
         sys.exit(1)
     except Exception as e:
@@ -723,21 +1583,84 @@ def main():
 
     logger.print_verbose('** Successfully transpiled all files with Babel.')
 
+    if application.reconcile:
+        logger.print_verbose('** Reconciling transpiled files with the manifest of Codemodel Rifle...')
+
+        try:
+            manifest = rifle.codemodel_rifle_get_manifest(git.current_revision)
+            files_list = rifle.reconcile(files_list, manifest, babel.transpiled_contents)
+        except RuntimeError as e:
+            logger.print_log('ERROR while reconciling with Codemodel Rifle.')
+            logger.print_log(e.message)
+            logger.print_log('You can still reimport the full branch (with the -f or --reimport-full-branch flag).')
+            logger.print_log('Aborting.')
+            sys.exit(1)
+        except Exception:
+            logger.print_log('UNEXPECTED ERROR while reconciling with Codemodel Rifle.')
+            logger.print_log('Aborting.')
+            sys.exit(1)
+        else:
+            # Deletions are collapsed based on the files imported to Codemodel Rifle
+            previous_files_list = manifest.keys()
+            logger.print_verbose('{0} files differ from Codemodel Rifle.'.format(len(files_list)))
+            logger.print_debug('THE RECONCILED FILELIST:')
+            for item in files_list:
+                # Printing diff mode and filename
+                logger.print_debug('{0} -> {1}'.format(item[0], item[1]))
+
+        logger.print_verbose('** Successfully reconciled transpiled files with the manifest of Codemodel Rifle.')
+
+        # Without any file to send, no request would record HEAD as the last imported commit of the revision
+        if not files_list:
+            logger.print_verbose('** Recording HEAD as the last commit for revision on Codemodel Rifle...')
+
+            try:
+                last_commit_recorded = rifle.codemodel_rifle_set_last_commit(git.current_revision, git.head)
+            except RuntimeError as e:
+                logger.print_log('ERROR while recording the last commit for revision on Codemodel Rifle.')
+                logger.print_log(e.message)
+                logger.print_log('Aborting.')
+                sys.exit(1)
+            except IOError as e:
+                logger.print_log('ERROR while sending request to Codemodel Rifle ({0}). '.format(e.message) +
+                                 'Request failed for more than {0} times. '.format(rifle.max_upload_trials) +
+                                 'Override this by specifying the --max-upload-trials flag.')
+                logger.print_log('Aborting.')
+                sys.exit(1)
+            except Exception:
+                logger.print_log('UNEXPECTED ERROR while recording the last commit for revision on Codemodel Rifle.')
+                logger.print_log('Aborting.')
+                sys.exit(1)
+
+            if last_commit_recorded:
+                logger.print_verbose('** Successfully recorded HEAD as the last commit for revision.')
+            else:
+                logger.print_log('WARNING: Codemodel Rifle does not support setting the last commit, so it still ' +
+                                 'records {0} for revision "{1}". '.format(rifle.last_uploaded_commit_on_revision,
+                                                                           git.current_revision) +
+                                 'The next incremental import will resend changes already on Codemodel Rifle.')
+
     logger.print_verbose('** Sending transpiled files to Codemodel Rifle...')
 
+    # Queries on a partially imported commit must not be cached
+    import_complete = True
+
     try:
-        rifle.handle(files_list, git.current_revision, git.head)
+        import_complete = rifle.handle(files_list, git.current_revision, git.head, babel.transpiled_contents,
+                                       previous_files_list)
     except RuntimeError as e:
         filename = e.message
         logger.print_log('ERROR thrown by Codemodel Rifle while uploading file "{0}". '.format(filename) +
                          'The file is possibly uploaded but potentially could not be parsed by Codemodel Rifle.')
         logger.print_log('Continuing with other files.')
+        import_complete = False
     except IOError as e:
         filename = e.message
         logger.print_log('ERROR while uploading file "{0}" '.format(filename) +
                          'Upload failed for more than {0} times. '.format(rifle.max_upload_trials) +
                          'Override this by specifying the --max-upload-trials flag.')
-        logger.print_log('At the next import, you are suggested to run a full import to the branch ' +
+        logger.print_log('At the next import, you are suggested to reconcile the branch ' +
+                         '(with the -r or --reconcile flag) or run a full import to the branch ' +
                          '(with the -f or --reimport-full-branch flag).')
         logger.print_log('Aborting.')
         sys.exit(1)
@@ -748,6 +1671,9 @@ def main():
 
     logger.print_verbose('** Successfully sent all files to Codemodel Rifle.')
 
+    run_queries(rifle, application, git.current_revision, git.head, args.query_poll_interval, args.query_timeout,
+                logger, import_complete)
+
     logger.print_verbose('* Successfully finished Codemodel Rifle import.')
 
 
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# Local stand-in for the Codemodel Rifle server, for testing the import script offline
+# Soma Lucz | Tresorit | 2016
+
+
+import argparse
+import BaseHTTPServer
+import urlparse
+import json
+import hashlib
+
+
+class Logger(object):
+    """Basic logger class
+
+    Every output of the stub server has to be through a Logger instance's print_log() method.
+    """
+
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    @staticmethod
+    def print_log(what):
+        print('CODEMODEL RIFLE STUB: {0}'.format(what))
+
+    def print_verbose(self, what):
+        if self.verbose:
+            self.print_log('VERBOSE: {0}'.format(what))
+
+
+class CodemodelRifleStore(object):
+    """In-memory store of the imported files
+
+    Does not parse or analyse anything, only keeps the contents of the imported files and the last imported commit
+    for each branch.
+    """
+
+    def __init__(self):
+        # branchid -> {path -> contents}
+        self.files = {}
+        # branchid -> commit hash
+        self.last_commits = {}
+        # query ID -> number of polls left until the query is done
+        self.running_queries = {}
+
+    def branch_files(self, branchid):
+        return self.files.setdefault(branchid, {})
+
+    def set_last_commit(self, branchid, commithash):
+        if commithash:
+            self.last_commits[branchid] = commithash
+
+    def add(self, branchid, path, contents):
+        self.branch_files(branchid)[path] = contents
+
+    def delete(self, branchid, path):
+        """Deletes the specified file, returns False if it does not exist"""
+        return self.branch_files(branchid).pop(path, None) is not None
+
+    @staticmethod
+    def apply_delta(base, delta):
+        """Applies a line-based delta to the base
+
+        The delta is a list of operations: [i, j] copies the lines i..j-1 of the base, a string is inserted as is.
+        """
+        # Lines are split as bytes, like at the delta's creation (unicode.splitlines() splits at more characters)
+        base_lines = [line.decode('utf-8') for line in base.splitlines(True)]
+
+        contents = []
+        for operation in delta:
+            if isinstance(operation, list):
+                contents.extend(base_lines[operation[0]:operation[1]])
+            else:
+                contents.append(operation)
+
+        return ''.join(contents).encode('utf-8')
+
+    def delete_prefix(self, branchid, prefix):
+        """Deletes every file under the specified directory prefix, returns the number of deleted files"""
+        files = self.branch_files(branchid)
+        paths = [path for path in files if path.startswith(prefix)]
+        for path in paths:
+            del files[path]
+
+        return len(paths)
+
+
+class CodemodelRifleStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler implementing the REST API of Codemodel Rifle used by the import script"""
+
+    store = None
+    logger = None
+    query_polls = 0
+
+    def parse_request_path(self):
+        url = urlparse.urlparse(self.path)
+        # Every parameter is expected exactly once
+        params = dict((key, values[0]) for key, values in urlparse.parse_qs(url.query).items())
+
+        return url.path.rstrip('/'), params
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length', 0))
+
+        return self.rfile.read(length)
+
+    def reply(self, http_response_code, json_object=None):
+        body = json.dumps(json_object) if json_object is not None else ''
+
+        self.send_response(http_response_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method):
+        path, params = self.parse_request_path()
+        parts = path.split('/')
+        # Sub-resources of handle, e.g. /codemodel/handle/prefix -> handle_prefix
+        if len(parts) >= 2 and parts[-2] == 'handle':
+            endpoint = 'handle_' + parts[-1]
+        else:
+            endpoint = parts[-1]
+
+        handler = getattr(self, '{0}_{1}'.format(method.lower(), endpoint), None)
+        if handler is None:
+            self.reply(404)
+            return
+
+        try:
+            handler(params)
+        except (KeyError, ValueError) as e:
+            self.logger.print_log('Bad request {0} {1} ({2})'.format(method, self.path, e))
+            self.reply(400)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        self.logger.print_verbose(format % args)
+
+    def get_lastcommit(self, params):
+        branchid = params['branchid']
+
+        if branchid in self.store.last_commits:
+            self.reply(200, {'commitHash': self.store.last_commits[branchid]})
+        else:
+            self.reply(200, {})
+
+    def post_lastcommit(self, params):
+        self.store.set_last_commit(params['branchid'], params['commithash'])
+        self.reply(200)
+
+    def post_query(self, params):
+        """Queries are not evaluated, every query has an empty result
+
+        With --query-polls N, the query is reported as running for the first N polls.
+        """
+        self.read_body()
+
+        if self.query_polls == 0:
+            self.reply(200, {'status': 'done', 'result': []})
+            return
+
+        query_id = str(len(self.store.running_queries) + 1)
+        self.store.running_queries[query_id] = self.query_polls
+        self.reply(200, {'status': 'running', 'queryId': query_id})
+
+    def get_query(self, params):
+        query_id = params['queryid']
+
+        if query_id not in self.store.running_queries:
+            self.reply(404)
+            return
+
+        if self.store.running_queries[query_id] > 1:
+            self.store.running_queries[query_id] -= 1
+            self.reply(200, {'status': 'running', 'queryId': query_id})
+            return
+
+        self.store.running_queries[query_id] = 0
+        self.reply(200, {'status': 'done', 'result': []})
+
+    def get_manifest(self, params):
+        files = self.store.branch_files(params['branchid'])
+        manifest = dict((path, hashlib.sha1(contents).hexdigest()) for path, contents in files.items())
+
+        self.reply(200, {'files': manifest})
+
+    def get_handle(self, params):
+        files = self.store.branch_files(params['branchid'])
+
+        if params['path'] not in files:
+            self.reply(404)
+            return
+
+        body = files[params['path']]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def post_handle(self, params):
+        self.store.add(params['branchid'], params['path'], self.read_body())
+        self.store.set_last_commit(params['branchid'], params.get('commithash'))
+        self.reply(200)
+
+    def put_handle(self, params):
+        self.post_handle(params)
+
+    def patch_handle(self, params):
+        delta = json.loads(self.read_body())
+        files = self.store.branch_files(params['branchid'])
+        base = files.get(params['path'])
+
+        # The delta can only be applied to the same version of the file it has been created against
+        if base is None or hashlib.sha1(base).hexdigest() != delta['base']:
+            self.logger.print_verbose('Base mismatch for the delta of {0}'.format(params['path']))
+            self.reply(409, {'hash': hashlib.sha1(base).hexdigest() if base is not None else None})
+            return
+
+        contents = self.store.apply_delta(base, delta['delta'])
+        contents_hash = hashlib.sha1(contents).hexdigest()
+
+        if contents_hash != delta['hash']:
+            raise ValueError('hash mismatch after applying the delta: {0}'.format(contents_hash))
+
+        self.store.add(params['branchid'], params['path'], contents)
+        self.store.set_last_commit(params['branchid'], params.get('commithash'))
+        self.reply(200, {'hash': contents_hash})
+
+    def delete_handle(self, params):
+        self.store.delete(params['branchid'], params['path'])
+        self.store.set_last_commit(params['branchid'], params.get('commithash'))
+        self.reply(200)
+
+    def delete_handle_prefix(self, params):
+        prefix = params['prefix']
+        # Without a trailing slash, app/lib would delete app/library/ as well
+        if not prefix.endswith('/'):
+            raise ValueError('prefix must end with a slash: {0}'.format(prefix))
+
+        deleted = self.store.delete_prefix(params['branchid'], prefix)
+        self.store.set_last_commit(params['branchid'], params.get('commithash'))
+        self.logger.print_verbose('Deleted {0} files under {1}'.format(deleted, prefix))
+        self.reply(200, {'deleted': deleted})
+
+    def delete_handle_bulk(self, params):
+        paths = json.loads(self.read_body())['paths']
+
+        deleted = 0
+        for path in paths:
+            if self.store.delete(params['branchid'], path):
+                deleted += 1
+
+        self.store.set_last_commit(params['branchid'], params.get('commithash'))
+        self.reply(200, {'deleted': deleted})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Codemodel Rifle server. Keeps the imported files in memory, ' +
+                    'without parsing or analysing them.')
+
+    parser.add_argument('-H', '--host', help='The host to listen on. Defaults to 127.0.0.1.',
+                        metavar='HOST', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, help='The port to listen on. Defaults to 8080.',
+                        metavar='PORT', default=8080)
+    parser.add_argument('-q', '--query-polls', type=int,
+                        help='Report submitted queries as running for this many polls before they are done. ' +
+                             'Defaults to 0, i.e. queries are done at once.',
+                        metavar='N', default=0)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on extra information logging, such as received requests.')
+    args = parser.parse_args()
+
+    CodemodelRifleStubHandler.store = CodemodelRifleStore()
+    CodemodelRifleStubHandler.logger = Logger(args.verbose)
+    CodemodelRifleStubHandler.query_polls = args.query_polls
+
+    server = BaseHTTPServer.HTTPServer((args.host, args.port), CodemodelRifleStubHandler)
+
+    Logger.print_log('Listening on http://{0}:{1}/codemodel'.format(args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()